@@ -5,7 +5,9 @@ import os
 import re
 import subprocess
 import sys
+import time
 from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 
 # begin constants definition
 
@@ -14,6 +16,13 @@ VERSION = '3.5.1'
 # Note: Do NOT remove this in cleanup!
 CACHE_FILE_PATH = '/var/cache/envycontrol/cache.json'
 
+# append-only log of switches, one JSON object per line
+HISTORY_FILE_PATH = os.path.join(
+    os.path.dirname(CACHE_FILE_PATH), 'history.jsonl')
+
+# rotate to HISTORY_FILE_PATH.1 once exceeded
+HISTORY_MAX_SIZE = 256 * 1024
+
 BLACKLIST_PATH = '/etc/modprobe.d/blacklist-nvidia.conf'
 
 BLACKLIST_CONTENT = '''# Automatically generated by EnvyControl
@@ -209,164 +218,632 @@ xrandr --setprovideroutputsource "{}" NVIDIA-0
 xrandr --auto
 '''
 
+DRM_SYSFS_PATH = '/sys/class/drm'
+
+AMDGPU_IDS_PATH = '/usr/share/libdrm/amdgpu.ids'
+
+# where distros install the Xorg DDX drivers
+XORG_DRIVERS_PATHS = [
+    '/usr/lib/xorg/modules/drivers',
+    '/usr/lib64/xorg/modules/drivers'
+]
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# memoized per boot, /run is cleared on reboot anyway
+AMD_IGPU_NAME_CACHE_PATH = '/run/envycontrol/amd_igpu_name.json'
+
+PCI_DEVICES_PATH = '/sys/bus/pci/devices'
+
+PROC_MODULES_PATH = '/proc/modules'
+
+PROC_UPTIME_PATH = '/proc/uptime'
+
+# seconds to wait for the dGPU to reach its target state
+VERIFY_TIMEOUT = 120
+
+VERIFY_MAX_INTERVAL = 8
+
 SUPPORTED_MODES = ['integrated', 'hybrid', 'nvidia']
 SUPPORTED_DISPLAY_MANAGERS = ['gdm', 'gdm3', 'sddm', 'lightdm']
 RTD3_MODES = [0, 1, 2, 3]
 
+# files removed by cleanup()
+MANAGED_PATHS = [
+    BLACKLIST_PATH,
+    UDEV_INTEGRATED_PATH,
+    UDEV_PM_PATH,
+    XORG_PATH,
+    EXTRA_XORG_PATH,
+    MODESET_PATH,
+    LIGHTDM_SCRIPT_PATH,
+    LIGHTDM_CONFIG_PATH,
+    # legacy files
+    '/etc/X11/xorg.conf.d/90-nvidia.conf',
+    '/lib/udev/rules.d/50-remove-nvidia.rules',
+    '/lib/udev/rules.d/80-nvidia-pm.rules'
+]
+
 # end constants definition
 
 
-def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_comp, coolbits_value, rtd3_value, use_nvidia_current):
-    print(f"Switching to {graphics_mode} mode")
+class EnvyControlError(Exception):
+    '''Base class for errors raised by EnvyControl'''
 
-    if graphics_mode == 'integrated':
 
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "disable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "disable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if service.returncode == 0:
-            print('Successfully disabled nvidia-persistenced.service')
-        else:
-            logging.error("An error ocurred while disabling service")
+class InvalidConfigError(EnvyControlError):
+    '''Raised when a SwitchConfig holds unsupported values'''
 
-        cleanup()
 
-        # blacklist all nouveau and Nvidia modules
-        create_file(BLACKLIST_PATH, BLACKLIST_CONTENT)
+class RootRequiredError(EnvyControlError):
+    '''Raised when an operation requires root privileges'''
 
-        # power off the Nvidia GPU with udev rules
-        create_file(UDEV_INTEGRATED_PATH, UDEV_INTEGRATED)
 
-        rebuild_initramfs()
-    elif graphics_mode == 'hybrid':
-        print(
-            f"Enable PCI-Express Runtime D3 (RTD3) Power Management: {rtd3_value or False}")
-        cleanup()
+class NvidiaGpuNotFoundError(EnvyControlError):
+    '''Raised when the Nvidia dGPU cannot be found on the PCI bus'''
 
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if service.returncode == 0:
-            print('Successfully enabled nvidia-persistenced.service')
-        else:
-            logging.error("An error ocurred while enabling service")
 
-        if rtd3_value == None:
-            if use_nvidia_current:
-                create_file(MODESET_PATH, MODESET_CURRENT_CONTENT)
+class SwitchError(EnvyControlError):
+    '''Raised by the CLI when a switch finished with errors'''
+
+
+class CacheError(EnvyControlError):
+    '''Raised when the cache at CACHE_FILE_PATH cannot be used'''
+
+
+class CommandError(EnvyControlError):
+    '''Raised when a required external command cannot be run'''
+
+
+class VerificationError(EnvyControlError):
+    '''Raised when the dGPU does not reach the state expected for the current mode'''
+
+
+@dataclass
+class SwitchConfig:
+    '''Options for a graphics mode switch'''
+    mode: str
+    display_manager: str = None
+    force_comp: bool = False
+    coolbits: int = None
+    rtd3: int = None
+    use_nvidia_current: bool = False
+
+    def __post_init__(self):
+        if self.mode not in SUPPORTED_MODES:
+            raise InvalidConfigError(
+                f"Unsupported graphics mode '{self.mode}'. Available choices: {', '.join(SUPPORTED_MODES)}")
+        if self.display_manager != None and self.display_manager not in SUPPORTED_DISPLAY_MANAGERS:
+            raise InvalidConfigError(
+                f"Unsupported Display Manager '{self.display_manager}'. Available choices: {', '.join(SUPPORTED_DISPLAY_MANAGERS)}")
+        if self.rtd3 != None and self.rtd3 not in RTD3_MODES:
+            raise InvalidConfigError(
+                f"Unsupported RTD3 value '{self.rtd3}'. Available choices: {', '.join(map(str, RTD3_MODES))}")
+
+
+@dataclass
+class SwitchPlan:
+    '''Changes a switch would make, computed without touching the system'''
+    config: SwitchConfig
+    # path -> content, in creation order
+    files: dict = field(default_factory=dict)
+    executables: list = field(default_factory=list)
+    # (action, service) pairs for systemctl
+    services: list = field(default_factory=list)
+    rebuild_initramfs: bool = True
+    # memoized for the current boot by apply()
+    amd_igpu_name: str = None
+
+
+@dataclass
+class SwitchResult:
+    '''Outcome of an applied switch'''
+    mode: str
+    files_created: list = field(default_factory=list)
+    files_removed: list = field(default_factory=list)
+    # (action, service, returncode) tuples
+    services: list = field(default_factory=list)
+    # one of 'rebuilt', 'failed', 'unsupported' or 'skipped'
+    initramfs: str = 'skipped'
+    # phase -> seconds
+    timings: dict = field(default_factory=dict)
+    errors: list = field(default_factory=list)
+    # problems that did not stop the switch, e.g. a missing service
+    warnings: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return len(self.errors) == 0
+
+
+@dataclass
+class VerifyResult:
+    '''State of the dGPU compared to what the current mode expects'''
+    mode: str
+    rtd3: bool = False
+    # check name -> passed
+    checks: dict = field(default_factory=dict)
+    # PCI bus -> runtime_status of Nvidia VGA/3D controllers
+    devices: dict = field(default_factory=dict)
+    # seconds since boot when the target state was reached
+    time_since_boot: float = None
+    # True when the state was already reached at the first poll and the
+    # actual time is unknown
+    upper_bound: bool = False
+
+    @property
+    def reached(self):
+        return len(self.checks) > 0 and all(self.checks.values())
+
+
+@dataclass
+class QueryResult:
+    '''Current graphics mode and the EnvyControl files behind it'''
+    mode: str
+    managed_files: list = field(default_factory=list)
+    cache: dict = None
+
+
+def plan(config):
+    '''Return the SwitchPlan for config without modifying the system'''
+    switch_plan = SwitchPlan(config)
+
+    if config.mode == 'integrated':
+        switch_plan.services.append(('disable', 'nvidia-persistenced.service'))
+
+        # blacklist all nouveau and Nvidia modules
+        switch_plan.files[BLACKLIST_PATH] = BLACKLIST_CONTENT
+
+        # power off the Nvidia GPU with udev rules
+        switch_plan.files[UDEV_INTEGRATED_PATH] = UDEV_INTEGRATED
+    elif config.mode == 'hybrid':
+        switch_plan.services.append(('enable', 'nvidia-persistenced.service'))
+
+        if config.rtd3 == None:
+            if config.use_nvidia_current:
+                switch_plan.files[MODESET_PATH] = MODESET_CURRENT_CONTENT
             else:
-                create_file(MODESET_PATH, MODESET_CONTENT)
+                switch_plan.files[MODESET_PATH] = MODESET_CONTENT
         else:
             # setup rtd3
-            if use_nvidia_current:
-                create_file(
-                    MODESET_PATH, MODESET_CURRENT_RTD3.format(rtd3_value))
+            if config.use_nvidia_current:
+                switch_plan.files[MODESET_PATH] = MODESET_CURRENT_RTD3.format(
+                    config.rtd3)
             else:
-                create_file(MODESET_PATH, MODESET_RTD3.format(rtd3_value))
-            create_file(UDEV_PM_PATH, UDEV_PM_CONTENT)
-
-        rebuild_initramfs()
-    elif graphics_mode == 'nvidia':
-        print(f"Enable ForceCompositionPipeline: {enable_force_comp}")
-        print(f"Enable Coolbits: {coolbits_value or False}")
-
-        if logging.getLogger().level == logging.DEBUG:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"])
-        else:
-            service = subprocess.run(
-                ["systemctl", "enable", "nvidia-persistenced.service"],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if service.returncode == 0:
-            print('Successfully enabled nvidia-persistenced.service')
-        else:
-            logging.error("An error ocurred while enabling service")
+                switch_plan.files[MODESET_PATH] = MODESET_RTD3.format(
+                    config.rtd3)
+            switch_plan.files[UDEV_PM_PATH] = UDEV_PM_CONTENT
+    elif config.mode == 'nvidia':
+        switch_plan.services.append(('enable', 'nvidia-persistenced.service'))
 
-        cleanup()
-        # get the Nvidia dGPU PCI bus
-        nvidia_gpu_pci_bus = get_nvidia_gpu_pci_bus()
+        # get the Nvidia dGPU PCI bus, cached when the dGPU is removed
+        nvidia_gpu_pci_bus = CachedConfig().get_nvidia_gpu_pci_bus()
 
         # get iGPU vendor
         igpu_vendor = get_igpu_vendor()
 
         # create the X.org config
         if igpu_vendor == 'intel':
-            create_file(XORG_PATH, XORG_INTEL.format(nvidia_gpu_pci_bus))
+            switch_plan.files[XORG_PATH] = XORG_INTEL.format(nvidia_gpu_pci_bus)
         elif igpu_vendor == 'amd':
-            create_file(XORG_PATH, XORG_AMD.format(nvidia_gpu_pci_bus))
+            switch_plan.files[XORG_PATH] = XORG_AMD.format(nvidia_gpu_pci_bus)
 
         # enable modeset for Nvidia driver
-        if use_nvidia_current:
-            create_file(MODESET_PATH, MODESET_CURRENT_CONTENT)
+        if config.use_nvidia_current:
+            switch_plan.files[MODESET_PATH] = MODESET_CURRENT_CONTENT
         else:
-            create_file(MODESET_PATH, MODESET_CONTENT)
+            switch_plan.files[MODESET_PATH] = MODESET_CONTENT
 
         # extra Xorg config
-        if enable_force_comp and coolbits_value != None:
-            create_file(EXTRA_XORG_PATH, EXTRA_XORG_CONTENT + FORCE_COMP +
-                        COOLBITS.format(coolbits_value) + 'EndSection\n')
-        elif enable_force_comp:
-            create_file(EXTRA_XORG_PATH, EXTRA_XORG_CONTENT +
-                        FORCE_COMP + 'EndSection\n')
-        elif coolbits_value != None:
-            create_file(EXTRA_XORG_PATH, EXTRA_XORG_CONTENT +
-                        COOLBITS.format(coolbits_value) + 'EndSection\n')
+        if config.force_comp and config.coolbits != None:
+            switch_plan.files[EXTRA_XORG_PATH] = EXTRA_XORG_CONTENT + FORCE_COMP + \
+                COOLBITS.format(config.coolbits) + 'EndSection\n'
+        elif config.force_comp:
+            switch_plan.files[EXTRA_XORG_PATH] = EXTRA_XORG_CONTENT + \
+                FORCE_COMP + 'EndSection\n'
+        elif config.coolbits != None:
+            switch_plan.files[EXTRA_XORG_PATH] = EXTRA_XORG_CONTENT + \
+                COOLBITS.format(config.coolbits) + 'EndSection\n'
 
         # try to detect the display manager if not provided
-        if user_display_manager == None:
+        if config.display_manager == None:
             display_manager = get_display_manager()
         else:
-            display_manager = user_display_manager
+            display_manager = config.display_manager
 
         # only sddm and lightdm require further config
+        if display_manager in ['sddm', 'lightdm'] and igpu_vendor == 'amd':
+            switch_plan.amd_igpu_name = get_amd_igpu_name(memoize=False)
+
         if display_manager == 'sddm':
-            # backup Xsetup
-            if os.path.exists(SDDM_XSETUP_PATH):
-                logging.info("Creating Xsetup backup")
-                with open(SDDM_XSETUP_PATH, mode='r', encoding='utf-8') as f:
-                    create_file(SDDM_XSETUP_PATH+'.bak', f.read())
-            create_file(SDDM_XSETUP_PATH,
-                        generate_xrandr_script(igpu_vendor), True)
+            # backup Xsetup, cleanup() restores an existing backup first
+            backup_path = SDDM_XSETUP_PATH + '.bak'
+            for source_path in [backup_path, SDDM_XSETUP_PATH]:
+                if os.path.exists(source_path):
+                    with open(source_path, mode='r', encoding='utf-8') as f:
+                        switch_plan.files[backup_path] = f.read()
+                    break
+            switch_plan.files[SDDM_XSETUP_PATH] = generate_xrandr_script(
+                igpu_vendor, switch_plan.amd_igpu_name)
+            switch_plan.executables.append(SDDM_XSETUP_PATH)
         elif display_manager == 'lightdm':
-            create_file(LIGHTDM_SCRIPT_PATH,
-                        generate_xrandr_script(igpu_vendor), True)
-            create_file(LIGHTDM_CONFIG_PATH, LIGHTDM_CONFIG_CONTENT)
+            switch_plan.files[LIGHTDM_SCRIPT_PATH] = generate_xrandr_script(
+                igpu_vendor, switch_plan.amd_igpu_name)
+            switch_plan.executables.append(LIGHTDM_SCRIPT_PATH)
+            switch_plan.files[LIGHTDM_CONFIG_PATH] = LIGHTDM_CONFIG_CONTENT
+
+    return switch_plan
+
+
+def apply(config, report=logging.info):
+    '''Switch to the graphics mode described by config and return a SwitchResult
+
+    Progress messages are passed to report as each step finishes.
+    '''
+    if os.geteuid() != 0:
+        raise RootRequiredError("This operation requires root privileges")
 
-        rebuild_initramfs()
+    start = time.monotonic()
+    from_mode = get_current_mode()
+    result = SwitchResult(config.mode)
+    try:
+        with CachedConfig().adapter():
+            switch_plan = plan(config)
+        if switch_plan.amd_igpu_name != None:
+            write_amd_igpu_name_cache(
+                read_sysfs_value(BOOT_ID_PATH), switch_plan.amd_igpu_name)
+        result.timings['plan'] = time.monotonic() - start
+
+        phase_start = time.monotonic()
+        for action, service in switch_plan.services:
+            returncode = set_service(action, service)
+            result.services.append((action, service, returncode))
+            if returncode == 0:
+                report(f'Successfully {action}d {service}')
+            else:
+                warning = f"An error ocurred while trying to {action} {service}"
+                logging.error(warning)
+                result.warnings.append(warning)
+        result.timings['services'] = time.monotonic() - phase_start
+
+        phase_start = time.monotonic()
+        result.files_removed = cleanup()
+        for path, content in switch_plan.files.items():
+            if create_file(path, content, path in switch_plan.executables):
+                result.files_created.append(path)
+            else:
+                # already logged by create_file()
+                result.errors.append(f"Failed to create file '{path}'")
+        result.timings['files'] = time.monotonic() - phase_start
+
+        if switch_plan.rebuild_initramfs:
+            phase_start = time.monotonic()
+            result.initramfs = rebuild_initramfs(report)
+            if result.initramfs == 'failed':
+                error = "An error ocurred while rebuilding the initramfs"
+                logging.error(error)
+                result.errors.append(error)
+            result.timings['initramfs'] = time.monotonic() - phase_start
+    except Exception as e:
+        result.errors.append(str(e))
+        raise
+    finally:
+        result.timings['total'] = time.monotonic() - start
+        append_history(from_mode, config, result)
+
+    return result
+
+
+def query():
+    '''Return the current graphics mode as a QueryResult'''
+    from json import loads
+    cache = None
+    if os.path.exists(CACHE_FILE_PATH):
+        try:
+            with open(CACHE_FILE_PATH, 'r', encoding='utf-8') as f:
+                cache = loads(f.read())
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read {CACHE_FILE_PATH}: {e}")
+    return QueryResult(
+        get_current_mode(),
+        [path for path in MANAGED_PATHS if os.path.exists(path)],
+        cache
+    )
+
+
+def verify(root='/', timeout=VERIFY_TIMEOUT):
+    '''Poll sysfs until the dGPU matches the current mode and return a VerifyResult'''
+    # the expected state comes from the files managed by EnvyControl
+    mode = get_current_mode(root)
+    rtd3_value = get_rtd3_value(root)
+    result = VerifyResult(mode, mode == 'hybrid' and os.path.exists(
+        rooted(root, UDEV_PM_PATH)) and rtd3_value != None and rtd3_value != 0)
+
+    start = time.monotonic()
+    interval = 0.5
+    first_poll = True
+    while True:
+        result.devices = get_nvidia_gpu_runtime_status(root)
+        modules = []
+        if result.mode != 'hybrid':
+            modules = get_loaded_modules(root)
+        nvidia_modules = [module for module in modules
+                          if module in ('nvidia', 'nvidia_current')]
+
+        if result.mode == 'integrated':
+            # nouveau is blacklisted as well
+            result.checks = {
+                'nvidia_gpu_removed': len(result.devices) == 0,
+                'dgpu_modules_unloaded': len(nvidia_modules) == 0 and 'nouveau' not in modules
+            }
+        elif result.mode == 'hybrid':
+            result.checks = {'nvidia_gpu_present': len(result.devices) > 0}
+            if result.rtd3:
+                result.checks['nvidia_gpu_suspended'] = len(result.devices) > 0 and all(
+                    status == 'suspended' for status in result.devices.values())
+        elif result.mode == 'nvidia':
+            result.checks = {
+                'nvidia_gpu_present': len(result.devices) > 0,
+                'nvidia_modules_loaded': len(nvidia_modules) > 0
+            }
+
+        if result.reached:
+            uptime = read_sysfs_value(rooted(root, PROC_UPTIME_PATH))
+            if uptime == None:
+                return result
+            result.time_since_boot = float(uptime.split()[0])
+            result.upper_bound = first_poll
+
+            # runtime PM accounting tells when the dGPU went to sleep
+            if result.rtd3:
+                suspended_since = get_nvidia_gpu_suspended_since(
+                    root, result.devices, result.time_since_boot)
+                if suspended_since != None:
+                    result.time_since_boot = suspended_since
+                    result.upper_bound = False
+            return result
+        first_poll = False
+
+        elapsed = time.monotonic() - start
+        if elapsed >= timeout:
+            logging.debug(f"Gave up waiting after {elapsed:.1f}s")
+            return result
+
+        # back off to avoid waking up the dGPU
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, VERIFY_MAX_INTERVAL)
+
+
+def get_rtd3_value(root='/'):
+    try:
+        with open(rooted(root, MODESET_PATH), 'r', encoding='utf-8') as f:
+            match = re.search(
+                r'NVreg_DynamicPowerManagement=(0x[0-9a-fA-F]+)', f.read())
+    except OSError:
+        return None
+    # --rtd3 0 disables runtime power management
+    if match:
+        return int(match.group(1), 16)
+    return None
+
+
+def get_nvidia_gpu_runtime_status(root='/'):
+    devices = {}
+    pci_devices_path = rooted(root, PCI_DEVICES_PATH)
+    try:
+        entries = sorted(os.listdir(pci_devices_path))
+    except OSError:
+        # polled repeatedly, avoid flooding the output
+        logging.debug(f"Could not read {pci_devices_path}")
+        return devices
+
+    for entry in entries:
+        device_path = os.path.join(pci_devices_path, entry)
+        vendor = read_sysfs_value(os.path.join(device_path, 'vendor'))
+        device_class = read_sysfs_value(os.path.join(device_path, 'class'))
+        # only VGA/3D controllers
+        if vendor == '0x10de' and device_class != None and device_class.startswith('0x03'):
+            devices[entry] = read_sysfs_value(
+                os.path.join(device_path, 'power', 'runtime_status'))
+    return devices
+
+
+def get_nvidia_gpu_suspended_since(root, devices, uptime):
+    suspended_since = None
+    for pci_bus in devices:
+        # milliseconds spent suspended, exact when the dGPU suspended once
+        suspended_time = read_sysfs_value(os.path.join(
+            rooted(root, PCI_DEVICES_PATH), pci_bus, 'power', 'runtime_suspended_time'))
+        try:
+            since = uptime - int(suspended_time) / 1000
+        except (TypeError, ValueError):
+            return None
+        # the target is reached once the last device is suspended
+        if suspended_since == None or since > suspended_since:
+            suspended_since = since
+    return suspended_since
+
+
+def get_loaded_modules(root='/'):
+    modules = []
+    try:
+        with open(rooted(root, PROC_MODULES_PATH), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    modules.append(line.split()[0])
+    except OSError:
+        logging.debug(f"Could not read {PROC_MODULES_PATH}")
+    return modules
+
+
+def rooted(root, path):
+    return os.path.join(root, path.lstrip('/'))
+
+
+def show_verify():
+    result = verify()
+    print(f"Expected {result.mode} mode" +
+          (' with RTD3' if result.rtd3 else ''))
+    for pci_bus, status in result.devices.items():
+        print(f"Nvidia GPU at {pci_bus}: {status or 'unknown'}")
+    for check, passed in result.checks.items():
+        print(f"{check}: {'ok' if passed else 'failed'}")
+    if not result.reached:
+        raise VerificationError(
+            f"Target state not reached within {VERIFY_TIMEOUT}s")
+    if result.time_since_boot != None and result.upper_bound:
+        print(
+            f"Reached target state at most {result.time_since_boot:.1f}s after boot")
+    elif result.time_since_boot != None:
+        print(
+            f"Reached target state {result.time_since_boot:.1f}s after boot")
+
+
+def append_history(from_mode, config, result):
+    from json import dumps
+    options = asdict(config)
+    del options['mode']
+    entry = {
+        'timestamp': int(time.time()),
+        'from': from_mode,
+        'to': config.mode,
+        'options': options,
+        'timings': {phase: round(seconds, 3) for phase, seconds in result.timings.items()},
+        'services': {service: returncode for _, service, returncode in result.services},
+        'initramfs': result.initramfs,
+        # service failures are recorded above and do not fail the switch
+        'outcome': 'success' if result.ok else 'failed'
+    }
+    try:
+        os.makedirs(os.path.dirname(HISTORY_FILE_PATH), exist_ok=True)
+        # keep at most one rotated log around
+        if os.path.exists(HISTORY_FILE_PATH) and os.path.getsize(HISTORY_FILE_PATH) >= HISTORY_MAX_SIZE:
+            os.replace(HISTORY_FILE_PATH, HISTORY_FILE_PATH + '.1')
+            logging.debug(f"Rotated file {HISTORY_FILE_PATH}")
+        with open(HISTORY_FILE_PATH, 'a', encoding='utf-8') as f:
+            f.write(dumps(entry, separators=(',', ':')) + '\n')
+    except OSError as e:
+        logging.warning(f"Failed to update history '{HISTORY_FILE_PATH}': {e}")
+
+
+def read_history():
+    from json import loads
+    # oldest entries first
+    for path in [HISTORY_FILE_PATH + '.1', HISTORY_FILE_PATH]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield loads(line)
+                except ValueError:
+                    logging.debug(f"Skipping malformed line in {path}")
+
+
+def get_history_stats():
+    totals = []
+    initramfs_time = 0.0
+    failures = 0
+    targets = {mode: 0 for mode in SUPPORTED_MODES}
+
+    # only keep the durations in memory
+    for entry in read_history():
+        # ignore entries not written by this version
+        if not isinstance(entry, dict) or entry.get('to') not in targets:
+            continue
+        targets[entry['to']] += 1
+        if entry.get('outcome') != 'success':
+            failures += 1
+            continue
+
+        # failed switches stop early and would skew the durations
+        timings = entry.get('timings', {})
+        if 'total' in timings:
+            totals.append(timings['total'])
+            initramfs_time += timings.get('initramfs', 0.0)
+
+    totals.sort()
+    switches = sum(targets.values())
+    return {
+        'switches': switches,
+        'failures': failures,
+        'failure_rate': failures / switches if switches else 0.0,
+        'p50': percentile(totals, 50),
+        'p95': percentile(totals, 95),
+        'initramfs_share': initramfs_time / sum(totals) if sum(totals) else 0.0,
+        'targets': targets
+    }
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    # nearest-rank method
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def show_history():
+    stats = get_history_stats()
+    if stats['switches'] == 0:
+        print(f'No switches recorded in {HISTORY_FILE_PATH}')
+        return
+    print(
+        f"Switches: {stats['switches']} ({stats['failures']} failed, {stats['failure_rate']:.1%})")
+    if stats['p50'] != None:
+        print(
+            f"Switch time: p50 {stats['p50']:.1f}s, p95 {stats['p95']:.1f}s")
+    print(f"Initramfs share: {stats['initramfs_share']:.1%}")
+    print('Target modes: ' + ', '.join(
+        f'{mode} {count}' for mode, count in stats['targets'].items()))
+
+
+def graphics_mode_switcher(graphics_mode, user_display_manager, enable_force_comp, coolbits_value, rtd3_value, use_nvidia_current):
+    assert_root()
+    config = SwitchConfig(graphics_mode, user_display_manager, enable_force_comp,
+                          coolbits_value, rtd3_value, use_nvidia_current)
+    print(f"Switching to {config.mode} mode")
+    if config.mode == 'hybrid':
+        print(
+            f"Enable PCI-Express Runtime D3 (RTD3) Power Management: {config.rtd3 or False}")
+    elif config.mode == 'nvidia':
+        print(f"Enable ForceCompositionPipeline: {config.force_comp}")
+        print(f"Enable Coolbits: {config.coolbits or False}")
+
+    result = apply(config, report=print)
+    # the errors themselves were logged as they happened
+    if not result.ok:
+        raise SwitchError(
+            f"Switching to {config.mode} mode finished with errors")
     print('Operation completed successfully')
     print('Please reboot your computer for changes to take effect!')
+    return result
+
+
+def set_service(action, service):
+    try:
+        if logging.getLogger().level == logging.DEBUG:
+            p = subprocess.run(["systemctl", action, service])
+        else:
+            p = subprocess.run(
+                ["systemctl", action, service],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        logging.debug(f"Failed to run 'systemctl': {e}")
+        # same as a shell for a missing command
+        return 127
+    return p.returncode
 
 
 def cleanup():
-    # define list of files to remove
-    to_remove = [
-        BLACKLIST_PATH,
-        UDEV_INTEGRATED_PATH,
-        UDEV_PM_PATH,
-        XORG_PATH,
-        EXTRA_XORG_PATH,
-        MODESET_PATH,
-        LIGHTDM_SCRIPT_PATH,
-        LIGHTDM_CONFIG_PATH,
-        # legacy files
-        '/etc/X11/xorg.conf.d/90-nvidia.conf',
-        '/lib/udev/rules.d/50-remove-nvidia.rules',
-        '/lib/udev/rules.d/80-nvidia-pm.rules'
-    ]
+    removed = []
 
     # remove each file in the list
-    for file_path in to_remove:
+    for file_path in MANAGED_PATHS:
         try:
             if os.path.exists(file_path):
                 os.remove(file_path)
+                removed.append(file_path)
                 logging.info(f"Removed file {file_path}")
         except OSError as e:
             # only warn if file exists (code 2)
@@ -377,15 +854,29 @@ def cleanup():
     backup_path = SDDM_XSETUP_PATH + ".bak"
     if os.path.exists(backup_path):
         logging.info("Restoring Xsetup backup")
-        with open(backup_path, mode="r", encoding="utf-8") as f:
-            create_file(SDDM_XSETUP_PATH, f.read())
-        # remove backup
-        os.remove(backup_path)
-        logging.info(f"Removed file {backup_path}")
+        try:
+            with open(backup_path, mode="r", encoding="utf-8") as f:
+                create_file(SDDM_XSETUP_PATH, f.read())
+            # remove backup
+            os.remove(backup_path)
+            removed.append(backup_path)
+            logging.info(f"Removed file {backup_path}")
+        except OSError as e:
+            logging.error(f"Failed to restore Xsetup backup '{backup_path}': {e}")
+
+    return removed
+
+
+def get_lspci_output():
+    try:
+        return subprocess.check_output(['lspci']).decode('utf-8')
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise CommandError(
+            f"Failed to run the 'lspci' command. Make sure pciutils is installed! ({e})")
 
 
 def get_nvidia_gpu_pci_bus():
-    lspci_output = subprocess.check_output(['lspci']).decode('utf-8')
+    lspci_output = get_lspci_output()
     for line in lspci_output.splitlines():
         if 'NVIDIA' in line and ('VGA compatible controller' in line or '3D controller' in line):
             # remove leading zeros
@@ -393,9 +884,8 @@ def get_nvidia_gpu_pci_bus():
             logging.info(f"Found Nvidia GPU at {pci_bus_id}")
             break
     else:
-        logging.error("Could not find Nvidia GPU")
-        print("Try switching to hybrid mode first!")
-        sys.exit(1)
+        raise NvidiaGpuNotFoundError(
+            "Could not find Nvidia GPU. Try switching to hybrid mode first!")
 
     # need to return the BusID in 'PCI:bus:device:function' format
     # also perform hexadecimal to decimal conversion
@@ -405,7 +895,7 @@ def get_nvidia_gpu_pci_bus():
 
 
 def get_igpu_vendor():
-    lspci_output = subprocess.check_output(["lspci"]).decode('utf-8')
+    lspci_output = get_lspci_output()
     for line in lspci_output.splitlines():
         if 'VGA compatible controller' in line or 'Display controller' in line:
             if 'Intel' in line:
@@ -428,24 +918,107 @@ def get_display_manager():
                 display_manager = os.path.basename(match.group(1))
                 logging.info(f"Found {display_manager} Display Manager")
                 return display_manager
-    except FileNotFoundError:
+    except OSError:
         logging.warning("Display Manager detection is not available")
 
 
-def generate_xrandr_script(igpu_vendor):
-    if igpu_vendor == 'intel':
-        return NVIDIA_XRANDR_SCRIPT.format('modesetting')
-    elif igpu_vendor == 'amd':
-        amd_igpu_name = get_amd_igpu_name()
-        if amd_igpu_name != None:
-            return NVIDIA_XRANDR_SCRIPT.format(amd_igpu_name)
-        else:
-            return NVIDIA_XRANDR_SCRIPT.format('modesetting')
+def generate_xrandr_script(igpu_vendor, amd_igpu_name=None):
+    if igpu_vendor == 'amd' and amd_igpu_name != None:
+        return NVIDIA_XRANDR_SCRIPT.format(amd_igpu_name)
     else:
         return NVIDIA_XRANDR_SCRIPT.format('modesetting')
 
 
-def get_amd_igpu_name():
+def get_amd_igpu_name(memoize=True):
+    boot_id = read_sysfs_value(BOOT_ID_PATH)
+    amd_igpu_name = read_amd_igpu_name_cache(boot_id)
+    if amd_igpu_name != None:
+        logging.info(f"Using cached AMD iGPU provider name {amd_igpu_name}")
+        return amd_igpu_name
+
+    # prefer DRM sysfs, xrandr needs a running X server
+    amd_igpu_name = get_amd_igpu_name_from_drm()
+    if amd_igpu_name == None:
+        amd_igpu_name = get_amd_igpu_name_from_xrandr()
+
+    if amd_igpu_name != None and memoize:
+        write_amd_igpu_name_cache(boot_id, amd_igpu_name)
+    return amd_igpu_name
+
+
+def get_drm_devices():
+    devices = []
+    try:
+        entries = sorted(os.listdir(DRM_SYSFS_PATH))
+    except OSError:
+        logging.warning(f"Could not read {DRM_SYSFS_PATH}")
+        return devices
+
+    for entry in entries:
+        # skip connectors (card0-eDP-1) and render nodes
+        if not re.fullmatch(r'card\d+', entry):
+            continue
+        device_path = os.path.join(DRM_SYSFS_PATH, entry, 'device')
+        driver_path = os.path.join(device_path, 'driver')
+        devices.append({
+            'card': entry,
+            'driver': os.path.basename(os.path.realpath(driver_path)) if os.path.exists(driver_path) else None,
+            'vendor': read_sysfs_value(os.path.join(device_path, 'vendor')),
+            'device': read_sysfs_value(os.path.join(device_path, 'device')),
+            'revision': read_sysfs_value(os.path.join(device_path, 'revision')),
+            'pci_bus': os.path.basename(os.path.realpath(device_path))
+        })
+    return devices
+
+
+def get_amd_igpu_name_from_drm():
+    for device in get_drm_devices():
+        if device['vendor'] != '0x1002':
+            continue
+        logging.info(
+            f"Found AMD iGPU at {device['pci_bus']} using {device['driver']} driver")
+        # mirror the provider names set by the Xorg DDX drivers, without
+        # them Xorg falls back to modesetting
+        if device['driver'] in ['amdgpu', 'radeon'] and not is_xorg_driver_installed(device['driver']):
+            logging.info(
+                f"Xorg {device['driver']} driver not installed, using modesetting")
+            return 'modesetting'
+        elif device['driver'] == 'radeon':
+            return 'radeon'
+        elif device['driver'] == 'amdgpu':
+            marketing_name = get_amdgpu_marketing_name(
+                device['device'], device['revision'])
+            return f"{marketing_name or 'Unknown AMD Radeon GPU'} @ pci:{device['pci_bus']}"
+    logging.warning(f"Could not find AMD iGPU in {DRM_SYSFS_PATH}")
+    return None
+
+
+def is_xorg_driver_installed(driver):
+    return any(os.path.exists(os.path.join(path, f'{driver}_drv.so'))
+               for path in XORG_DRIVERS_PATHS)
+
+
+def get_amdgpu_marketing_name(device_id, revision_id):
+    if device_id == None or revision_id == None:
+        return None
+    try:
+        with open(AMDGPU_IDS_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                # format: device_id, revision_id, product_name
+                fields = line.split(',', 2)
+                if line.startswith('#') or len(fields) != 3:
+                    continue
+                try:
+                    if int(fields[0], 16) == int(device_id, 16) and int(fields[1], 16) == int(revision_id, 16):
+                        return fields[2].strip()
+                except ValueError:
+                    continue
+    except OSError:
+        logging.warning(f"Could not read {AMDGPU_IDS_PATH}")
+    return None
+
+
+def get_amd_igpu_name_from_xrandr():
     if not os.path.exists('/usr/bin/xrandr'):
         logging.warning(
             "The 'xrandr' command is not available. Make sure the package is installed!")
@@ -453,10 +1026,11 @@ def get_amd_igpu_name():
 
     try:
         xrandr_output = subprocess.check_output(
-            ['xrandr', '--listproviders']).decode('utf-8')
-    except subprocess.CalledProcessError:
+            ['xrandr', '--listproviders'], stderr=subprocess.DEVNULL).decode('utf-8')
+    except (subprocess.CalledProcessError, OSError):
         logging.warning(
             "Failed to run the 'xrandr' command.")
+        return None
 
     pattern = re.compile(r'(name:).*(ATI*|AMD*|AMD\/ATI)*')
 
@@ -468,10 +1042,44 @@ def get_amd_igpu_name():
         return None
 
 
-def rebuild_initramfs():
+def read_amd_igpu_name_cache(boot_id):
+    from json import loads
+    try:
+        with open(AMD_IGPU_NAME_CACHE_PATH, 'r', encoding='utf-8') as f:
+            obj = loads(f.read())
+    except (OSError, ValueError):
+        return None
+    # discard values from a previous boot
+    if boot_id == None or not isinstance(obj, dict) or obj.get('boot_id') != boot_id:
+        return None
+    return obj.get('amd_igpu_name')
+
+
+def write_amd_igpu_name_cache(boot_id, amd_igpu_name):
+    from json import dump
+    if boot_id == None:
+        return
+    try:
+        os.makedirs(os.path.dirname(AMD_IGPU_NAME_CACHE_PATH), exist_ok=True)
+        with open(AMD_IGPU_NAME_CACHE_PATH, 'w', encoding='utf-8') as f:
+            dump({'boot_id': boot_id, 'amd_igpu_name': amd_igpu_name}, fp=f)
+        logging.debug(f"Created file {AMD_IGPU_NAME_CACHE_PATH}")
+    except OSError as e:
+        logging.debug(f"Failed to create file '{AMD_IGPU_NAME_CACHE_PATH}': {e}")
+
+
+def read_sysfs_value(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def rebuild_initramfs(report=logging.info):
     # OSTree systems first
     if any(os.path.exists(dir) for dir in ['/ostree', '/sysroot/ostree']):
-        print('Rebuilding the initramfs with rpm-ostree...')
+        report('Rebuilding the initramfs with rpm-ostree...')
         command = ['rpm-ostree', 'initramfs', '--enable', '--arg=--force']
 
     # Debian and Ubuntu derivatives
@@ -489,17 +1097,24 @@ def rebuild_initramfs():
     else:
         command = []
 
-    if len(command) != 0:
-        print('Rebuilding the initramfs...')
+    if len(command) == 0:
+        logging.info("Could not detect how to rebuild the initramfs")
+        return 'unsupported'
+
+    report('Rebuilding the initramfs...')
+    try:
         if logging.getLogger().level == logging.DEBUG:
             p = subprocess.run(command)
         else:
             p = subprocess.run(
                 command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if p.returncode == 0:
-            print('Successfully rebuilt the initramfs!')
-        else:
-            logging.error("An error ocurred while rebuilding the initramfs")
+    except OSError as e:
+        logging.debug(f"Failed to run '{command[0]}': {e}")
+        return 'failed'
+    if p.returncode == 0:
+        report('Successfully rebuilt the initramfs!')
+        return 'rebuilt'
+    return 'failed'
 
 
 def create_file(path, content, executable=False):
@@ -517,14 +1132,15 @@ def create_file(path, content, executable=False):
         if executable:
             subprocess.run(['chmod', '+x', path], stdout=subprocess.DEVNULL)
             logging.info(f"Added execution privilege to file {path}")
+        return True
     except OSError as e:
         logging.error(f"Failed to create file '{path}': {e}")
+        return False
 
 
 def assert_root():
     if os.geteuid() != 0:
-        logging.error("This operation requires root privileges")
-        sys.exit(1)
+        raise RootRequiredError("This operation requires root privileges")
 
 
 def main():
@@ -556,6 +1172,10 @@ def main():
                         help='Delete cache created by EnvyControl')
     parser.add_argument('--cache-query', action='store_true',
                         help='Show cache created by EnvyControl')
+    parser.add_argument('--history', action='store_true',
+                        help='Show statistics of past switches recorded by EnvyControl')
+    parser.add_argument('--verify', action='store_true',
+                        help='Wait until the Nvidia GPU reaches the state expected for the current mode')
     parser.add_argument('--verbose', default=False, action='store_true',
                         help='Enable verbose mode')
 
@@ -573,13 +1193,20 @@ def main():
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    try:
+        run_command(args)
+    except EnvyControlError as e:
+        logging.error(e)
+        sys.exit(1)
+
+
+def run_command(args):
     if args.query:
-        mode = get_current_mode()
-        print(mode)
+        print(query().mode)
         return
     elif args.cache_create:
         assert_root()
-        CachedConfig(args).create_cache_file()
+        CachedConfig().create_cache_file()
         return
     elif args.cache_delete:
         assert_root()
@@ -588,53 +1215,51 @@ def main():
     elif args.cache_query:
         CachedConfig.show_cache_file()
         return
+    elif args.history:
+        show_history()
+        return
+    elif args.verify:
+        show_verify()
+        return
 
-    if args.switch or args.reset_sddm or args.reset:
-        with CachedConfig(args).adapter():
-            if args.switch:
-                assert_root()
-                graphics_mode_switcher(
-                    args.switch, args.dm,
-                    args.force_comp, args.coolbits, args.rtd3, args.use_nvidia_current
-                )
-            elif args.reset_sddm:
-                assert_root()
+    if args.switch:
+        # apply() takes care of the cache
+        graphics_mode_switcher(
+            args.switch, args.dm,
+            args.force_comp, args.coolbits, args.rtd3, args.use_nvidia_current
+        )
+    elif args.reset_sddm or args.reset:
+        assert_root()
+        with CachedConfig().adapter():
+            if args.reset_sddm:
                 create_file(SDDM_XSETUP_PATH, SDDM_XSETUP_CONTENT, True)
                 print('Operation completed successfully')
             elif args.reset:
-                assert_root()
                 cleanup()
-                CachedConfig.delete_cache_file()
-                rebuild_initramfs()
+                if os.path.exists(CACHE_FILE_PATH):
+                    CachedConfig.delete_cache_file()
+                if rebuild_initramfs(print) == 'failed':
+                    logging.error(
+                        "An error ocurred while rebuilding the initramfs")
                 print('Operation completed successfully')
 
 
 class CachedConfig:
     '''Adapter for config from CACHE_FILE_PATH'''
 
-    def __init__(self, app_args) -> None:
-        self.app_args = app_args
+    def __init__(self) -> None:
         self.current_mode = get_current_mode()
 
     @contextmanager
     def adapter(self):
-        global get_nvidia_gpu_pci_bus
-        use_cache = os.path.exists(CACHE_FILE_PATH)
-
         if self.is_hybrid():  # recreate cache file when in hybrid mode
             self.create_cache_file()
 
-        if use_cache:
-            self.read_cache_file()  # might not be in hybrid mode
-
-            # rebind function to use cached value instead of detection
-            get_nvidia_gpu_pci_bus = self.get_nvidia_gpu_pci_bus
-
         yield  # back to main ...
 
     def create_cache_file(self):
         if not self.is_hybrid():
-            raise ValueError(
+            raise CacheError(
                 '--cache-create requires that the system be in the hybrid Optimus mode')
 
         self.nvidia_gpu_pci_bus = get_nvidia_gpu_pci_bus()
@@ -650,25 +1275,40 @@ class CachedConfig:
         return 'hybrid' == self.current_mode
 
     def get_nvidia_gpu_pci_bus(self):
-        return self.nvidia_gpu_pci_bus
+        # the dGPU is only guaranteed to be visible in hybrid mode
+        if not self.is_hybrid() and os.path.exists(CACHE_FILE_PATH):
+            self.read_cache_file()
+            return self.nvidia_gpu_pci_bus
+        return get_nvidia_gpu_pci_bus()
 
     @staticmethod
     def delete_cache_file():
-        os.remove(CACHE_FILE_PATH)
-        os.removedirs(os.path.dirname(CACHE_FILE_PATH))
+        if not os.path.exists(CACHE_FILE_PATH):
+            raise CacheError(f'No cache present at {CACHE_FILE_PATH}')
+        try:
+            os.remove(CACHE_FILE_PATH)
+            # keep the folder if the history log lives there
+            if len(os.listdir(os.path.dirname(CACHE_FILE_PATH))) == 0:
+                os.removedirs(os.path.dirname(CACHE_FILE_PATH))
+        except OSError as e:
+            raise CacheError(f"Failed to remove file '{CACHE_FILE_PATH}': {e}")
         logging.debug(f"Removed file {CACHE_FILE_PATH}")
 
     def read_cache_file(self):
         from json import loads
         if os.path.exists(CACHE_FILE_PATH):
-            with open(CACHE_FILE_PATH, 'r', encoding='utf-8') as f:
-                content = f.read()
-            self.obj = loads(content)
-            self.nvidia_gpu_pci_bus = self.obj['nvidia_gpu_pci_bus']
+            try:
+                with open(CACHE_FILE_PATH, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                self.obj = loads(content)
+                self.nvidia_gpu_pci_bus = self.obj['nvidia_gpu_pci_bus']
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                raise CacheError(
+                    f"Failed to read cache '{CACHE_FILE_PATH}': {e}")
         elif self.is_hybrid():
             self.nvidia_gpu_pci_bus = get_nvidia_gpu_pci_bus()
         else:
-            raise ValueError(
+            raise CacheError(
                 'No cache present. Operation requires that the system be in the hybrid Optimus mode')
 
     @staticmethod
@@ -681,19 +1321,23 @@ class CachedConfig:
 
     def write_cache_file(self):
         from json import dump
-        os.makedirs(os.path.dirname(CACHE_FILE_PATH), exist_ok=True)
+        try:
+            os.makedirs(os.path.dirname(CACHE_FILE_PATH), exist_ok=True)
 
-        with open(CACHE_FILE_PATH, 'w', encoding='utf-8') as f:
-            dump(self.obj, fp=f, indent=4, sort_keys=False)
+            with open(CACHE_FILE_PATH, 'w', encoding='utf-8') as f:
+                dump(self.obj, fp=f, indent=4, sort_keys=False)
+        except OSError as e:
+            raise CacheError(
+                f"Failed to create file '{CACHE_FILE_PATH}': {e}")
 
         logging.debug(f"Created file {CACHE_FILE_PATH}")
 
 
-def get_current_mode():
+def get_current_mode(root='/'):
     mode = 'hybrid'
-    if os.path.exists(BLACKLIST_PATH) and (os.path.exists(UDEV_INTEGRATED_PATH) or os.path.exists('/lib/udev/rules.d/50-remove-nvidia.rules')):
+    if os.path.exists(rooted(root, BLACKLIST_PATH)) and (os.path.exists(rooted(root, UDEV_INTEGRATED_PATH)) or os.path.exists(rooted(root, '/lib/udev/rules.d/50-remove-nvidia.rules'))):
         mode = 'integrated'
-    elif os.path.exists(XORG_PATH) and os.path.exists(MODESET_PATH):
+    elif os.path.exists(rooted(root, XORG_PATH)) and os.path.exists(rooted(root, MODESET_PATH)):
         mode = 'nvidia'
     return mode
 